@@ -1,19 +1,39 @@
-import xarray
-
-from regional_downscaling.provider.download import (
-    download_cerra_data,
-    download_era5_data,
-)
-from regional_downscaling.provider.preprocess import preprocess
+from concurrent.futures import ThreadPoolExecutor
 
 
 def main():
-    era5_data_path = download_era5_data()
-    era5_data = xarray.open_dataset(era5_data_path)
-    era5_data = preprocess(era5_data, "ERA5", "tas", {"tas": "t2m"})
-    cerra_data_path = download_cerra_data()
-    cerra_data = xarray.open_dataset(cerra_data_path)
-    cerra_data = preprocess(cerra_data, "CERRA", "tas", {"tas": "t2m"})
+    """
+    Download and preprocess ERA5 and CERRA 2m temperature.
+
+    The returned datasets are lazy (dask-backed): nothing is read from disk until
+    the data is used, so selecting e.g. a single time step before calling
+    `.compute()` or `.load()` only reads the chunks needed for it.
+
+    Returns
+    -------
+    tuple of xarray.Dataset
+        The preprocessed ERA5 and CERRA datasets.
+    """
+    from regional_downscaling.provider.download import (
+        download_cerra_data,
+        download_era5_data,
+    )
+    from regional_downscaling.provider.preprocess import (
+        open_for_preprocess,
+        preprocess,
+    )
+
+    # Both requests are queue-bound on the CDS side, so submit them together.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        era5_future = executor.submit(download_era5_data)
+        cerra_future = executor.submit(download_cerra_data)
+        era5_data_path, cerra_data_path = era5_future.result(), cerra_future.result()
+    era5_data = preprocess(
+        open_for_preprocess(era5_data_path), "ERA5", "tas", {"tas": "t2m"}
+    )
+    cerra_data = preprocess(
+        open_for_preprocess(cerra_data_path), "CERRA", "tas", {"tas": "t2m"}
+    )
     return era5_data, cerra_data
 
 
@@ -1,11 +1,9 @@
+from typing import TYPE_CHECKING
+
 import click
-import xarray
 
-from regional_downscaling.provider.download import (
-    download_cerra_data,
-    download_era5_data,
-)
-from regional_downscaling.provider.preprocess import preprocess
+if TYPE_CHECKING:
+    import xarray
 
 
 @click.group()
@@ -73,6 +71,16 @@ def provider_cli(
     -------
     None
     """
+    # Imported here so that --help and option errors do not pay for xarray/cdsapi
+    from regional_downscaling.provider.download import (
+        download_cerra_data,
+        download_era5_data,
+    )
+    from regional_downscaling.provider.preprocess import (
+        open_for_preprocess,
+        preprocess,
+    )
+
     day = None
     time = None
     if project == "CERRA":
@@ -80,7 +88,7 @@ def provider_cli(
         data_path = download_cerra_data(
             variable=cds_variable[variable],
             year=str(year),
-            month="{:02.0f}".format(month),
+            month=f"{month:02d}",
             day=day,
             time=time,
             output_directory=output_dir,
@@ -90,7 +98,7 @@ def provider_cli(
         data_path = download_era5_data(
             variable=cds_variable[variable],
             year=str(year),
-            month="{:02.0f}".format(month),
+            month=f"{month:02d}",
             day=day,
             time=time,
             output_directory=output_dir,
@@ -98,11 +106,41 @@ def provider_cli(
     else:
         raise NotImplementedError
 
-    data_raw = xarray.open_dataset(data_path)
+    data_raw = open_for_preprocess(data_path)
     data_processed = preprocess(
         data_raw, project=project, variable="tas", variable_map={"tas": "t2m"}
     )
-    data_processed.to_netcdf("/tmp/trial_processed.nc")
+    data_processed.to_netcdf(
+        "/tmp/trial_processed.nc",
+        encoding=compression_encoding(data_processed),
+        engine="netcdf4",
+    )
+
+
+def compression_encoding(ds: "xarray.Dataset", complevel: int = 4) -> dict:
+    """
+    Build a netCDF encoding that compresses every data variable.
+
+    Uses zlib with the shuffle filter, and chunks 3D variables one time step
+    by 256x256 grid points (capped to the variable shape).
+
+    Parameters
+    ----------
+    ds: xarray.Dataset
+    complevel: int
+
+    Returns
+    -------
+    dict
+    """
+    encoding = {}
+    for var in ds.data_vars:
+        encoding[var] = {"zlib": True, "complevel": complevel, "shuffle": True}
+        if ds[var].ndim == 3:
+            encoding[var]["chunksizes"] = tuple(
+                min(chunk, size) for chunk, size in zip((1, 256, 256), ds[var].shape)
+            )
+    return encoding
 
 
 if __name__ == "__main__":
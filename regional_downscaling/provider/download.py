@@ -1,8 +1,80 @@
 import calendar
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Union
+from typing import Iterator, List, Set, Union
 
 import cdsapi
+import xarray
+
+__all__ = [
+    "download_era5_data",
+    "download_cerra_data",
+    "get_output_path",
+]
+
+# CDS only runs a handful of requests per user at a time, so more workers than
+# this just sit in the queue.
+_MAX_WORKERS = 5
+
+# Largest request sent to the CDS, which rejects requests of more than ~120000
+# items only after they have been queued
+_MAX_REQUEST_ITEMS = 100_000
+
+# Leading bytes of the file formats the CDS delivers: netCDF classic/64-bit
+# offset, netCDF4 (HDF5) and GRIB
+_MAGIC_BYTES = (b"CDF\x01", b"CDF\x02", b"\x89HDF", b"GRIB")
+
+# File extension for each format the CDS can deliver
+_SUFFIXES = {"grib": ".grib", "netcdf": ".nc"}
+
+# Times requested when none are given: CERRA is 3-hourly and ERA5 hourly
+_HOURS_3H = tuple(f"{hour:02d}:00" for hour in range(0, 24, 3))
+_HOURS_1H = tuple(f"{hour:02d}:00" for hour in range(0, 24, 1))
+_ALL_DAYS = tuple(f"{day:02d}" for day in range(1, 32))
+
+# Directories already created by this process, to skip repeated mkdir calls
+_MKDIR_CACHE: Set[Path] = set()
+
+_local = threading.local()
+
+logger = logging.getLogger(__name__)
+
+
+def _client() -> cdsapi.Client:
+    """
+    Return this thread's CDS client, creating it on first use.
+
+    Clients are reused so repeated downloads share one HTTP session, but they
+    are not shared between threads since concurrent retrieves on one client are
+    not safe.
+    """
+    if not hasattr(_local, "client"):
+        _local.client = cdsapi.Client()
+    return _local.client
+
+
+@dataclass
+class _CdsRequest:
+    """A single CDS retrieve call: catalogue entry, request payload and target."""
+
+    name: str
+    payload: dict
+    path: Path
+
+    def retrieve(self) -> Path:
+        """Submit the request, wait for its result and download it to `path`."""
+        with _atomic_target(self.path) as target:
+            _client().retrieve(self.name, self.payload, target)
+        _write_request_sidecar(self.path, self.payload)
+        return self.path
 
 
 def download_cerra_data(
@@ -14,8 +86,8 @@ def download_cerra_data(
     month: Union[str, list] = "01",
     day: Union[str, list, None] = "01",
     time: Union[str, list, None] = "00:00",
-    fmt: str = "netcdf",
-    output_directory: str = "/tmp",
+    fmt: str = "grib",
+    output_directory: Union[str, os.PathLike] = "/tmp",
 ) -> Path:
     """
     Downloads CERRA data for a specified variable, level type, data type,
@@ -41,8 +113,8 @@ def download_cerra_data(
     time : str or list, optional
         The time of the data to provider in the format HH:MM, defaults to '00:00'.
     fmt : str, optional
-        The format to provider the data in, defaults to 'netcdf'.
-    output_directory : str, optional
+        The format to provider the data in, 'grib' or 'netcdf', defaults to 'grib'.
+    output_directory : str or os.PathLike, optional
         The output directory to save the downloaded data, defaults to '/tmp'.
 
     Returns
@@ -52,48 +124,21 @@ def download_cerra_data(
 
     """
 
-    output_path = get_output_path(
-        catalogue_entry="reanalysis-cerra-single-levels",
-        output_directory=output_directory,
-        variable=variable,
-        day=day,
-        month=month,
-        year=year,
-        hour=time,
+    payload = {
+        "variable": variable,
+        "level_type": level_type,
+        "data_type": data_type,
+        "product_type": product_type,
+        "year": year,
+        "month": month,
+        "day": day,
+        "time": time,
+        "format": fmt,
+    }
+    return _cds_retrieve(
+        "reanalysis-cerra-single-levels", payload, output_directory, _HOURS_3H
     )
 
-    if output_path.exists():
-        return output_path
-    else:
-        output_path.parent.mkdir(parents=True, exist_ok=True, mode=0o777)
-
-    c = cdsapi.Client()
-
-    if not day:
-        _, days_in_month = calendar.monthrange(int(year), int(month))
-        day = [day for day in range(1, days_in_month + 1)]
-
-    if not time:
-        hours = ["{:02.0f}".format(hour) for hour in range(0, 24, 3)]
-        time = [f"{hour}:00" for hour in hours]
-
-    c.retrieve(
-        "reanalysis-cerra-single-levels",
-        {
-            "variable": variable,
-            "level_type": level_type,
-            "data_type": data_type,
-            "product_type": product_type,
-            "year": year,
-            "month": month,
-            "day": day,
-            "time": time,
-            "format": fmt,
-        },
-        output_path,
-    )
-    return output_path
-
 
 def download_era5_data(
     variable: str = "2m_temperature",
@@ -102,8 +147,8 @@ def download_era5_data(
     month: Union[str, list, None] = "01",
     day: Union[str, list, None] = "01",
     time: Union[str, list, None] = "00:00",
-    fmt: str = "netcdf",
-    output_directory: str = "/tmp",
+    fmt: str = "grib",
+    output_directory: Union[str, os.PathLike] = "/tmp",
 ) -> Path:
     """
     Downloads ERA5 data for a specified variable, year, month, day,
@@ -124,8 +169,8 @@ def download_era5_data(
     time : str or list, optional
         The time of the data to provide in the format HH:MM, defaults to '00:00'.
     fmt : str, optional
-        The format to provide the data in, defaults to 'netcdf'.
-    output_directory : str, optional
+        The format to provide the data in, 'grib' or 'netcdf', defaults to 'grib'.
+    output_directory : str or os.PathLike, optional
         The output directory to save the downloaded data, defaults to '/tmp'.
 
     Returns
@@ -134,90 +179,454 @@ def download_era5_data(
         The output path of the downloaded data.
 
     """
+    payload = {
+        "product_type": product_type,
+        "variable": variable,
+        "year": year,
+        "month": month,
+        "day": day,
+        "time": time,
+        "format": fmt,
+    }
+    return _cds_retrieve(
+        "reanalysis-era5-single-levels", payload, output_directory, _HOURS_1H
+    )
+
+
+def _cds_retrieve(
+    catalogue_entry: str,
+    payload: dict,
+    output_directory: Union[str, os.PathLike],
+    hours: tuple,
+) -> Path:
+    """
+    Retrieve a CDS request unless it is already cached, and return its path.
+
+    Missing days and times in the payload are expanded to the whole month and
+    to `hours`. Requests spanning several months are split per month.
+
+    Parameters
+    ----------
+    catalogue_entry : str
+        The catalogue entry the request is sent to.
+    payload : dict
+        The request payload, as given by the caller.
+    output_directory : str or os.PathLike
+        The output directory to save the downloaded data.
+    hours : tuple of str
+        The times (HH:MM) to request when the payload has no time.
+
+    Returns
+    -------
+    pathlib.Path
+        The output path of the downloaded data.
+    """
+    variable, year, month = payload["variable"], payload["year"], payload["month"]
+    day, time = payload["day"], payload["time"]
+    if not time:
+        payload["time"] = list(hours)
+
+    # Multi-month requests are sent one month at a time, so check each month
+    for single_month in month if isinstance(month, list) else [month]:
+        _check_request_size(
+            dict(
+                payload,
+                month=single_month,
+                day=day or _days_of_month(year, single_month),
+            )
+        )
+
     output_path = get_output_path(
-        catalogue_entry="reanalysis-era5-single-levels",
+        catalogue_entry=catalogue_entry,
         output_directory=output_directory,
         variable=variable,
         day=day,
         month=month,
         year=year,
         hour=time,
+        request=payload,
     )
 
-    if output_path.exists():
+    if _is_cached(output_path):
         return output_path
     else:
-        output_path.parent.mkdir(parents=True, exist_ok=True, mode=0o777)
+        _make_parent_directory(output_path)
+
+    if isinstance(month, list):
+        requests = _split_per_month(
+            catalogue_entry, payload, output_directory, variable
+        )
+        return _retrieve_and_merge(requests, output_path, payload)
 
     if not day:
-        _, days_in_month = calendar.monthrange(int(year), int(month))
-        day = [day for day in range(1, days_in_month + 1)]
+        payload["day"] = _days_of_month(year, month)
 
-    if not time:
-        hours = ["{:02.0f}".format(hour) for hour in range(0, 24, 1)]
-        time = [f"{hour}:00" for hour in hours]
-
-    c = cdsapi.Client()
-
-    c.retrieve(
-        "reanalysis-era5-single-levels",
-        {
-            "product_type": product_type,
-            "variable": variable,
-            "year": year,
-            "month": month,
-            "day": day,
-            "time": time,
-            "format": fmt,
-        },
-        output_path,
-    )
+    c = _client()
+
+    with _atomic_target(output_path) as target:
+        c.retrieve(catalogue_entry, payload, target)
+    _write_request_sidecar(output_path, payload)
     return output_path
 
 
+def _split_per_month(
+    catalogue_entry: str,
+    payload: dict,
+    output_directory: Union[str, os.PathLike],
+    variable: str,
+) -> List[_CdsRequest]:
+    """
+    Split a multi-month request into one CDS request per month.
+
+    One month is the chunk size CDS recommends for hourly data; smaller
+    requests queue independently and can be processed in parallel.
+
+    Parameters
+    ----------
+    catalogue_entry : str
+        The catalogue entry the request is sent to.
+    payload : dict
+        The request payload, with a list of months under 'month'.
+    output_directory : str or os.PathLike
+        The output directory to save the monthly files.
+    variable : str
+        The variable name for the output files.
+
+    Returns
+    -------
+    list of _CdsRequest
+        One request per month, each targeting its own monthly file.
+    """
+    day, time, year = payload["day"], payload["time"], payload["year"]
+    requests = []
+    for month in payload["month"]:
+        monthly_payload = dict(payload, month=month)
+        path = get_output_path(
+            catalogue_entry=catalogue_entry,
+            output_directory=output_directory,
+            variable=variable,
+            day=day,
+            month=month,
+            year=year,
+            hour=time,
+            request=monthly_payload,
+        )
+        if not day:
+            monthly_payload["day"] = _days_of_month(year, month)
+        requests.append(_CdsRequest(catalogue_entry, monthly_payload, path))
+    return requests
+
+
+def _check_request_size(payload: dict) -> int:
+    """
+    Fail fast on requests the CDS would reject for being too large.
+
+    The number of items is the product of the number of variables, years,
+    months, days and times requested.
+
+    Parameters
+    ----------
+    payload : dict
+        The request payload, with days and times already expanded.
+
+    Returns
+    -------
+    int
+        The number of items in the request.
+
+    Raises
+    ------
+    ValueError
+        If the request has more than _MAX_REQUEST_ITEMS items.
+    """
+    n_items = 1
+    for key in ("variable", "year", "month", "day", "time"):
+        value = payload.get(key)
+        n_items *= len(value) if isinstance(value, (list, tuple)) else 1
+    logger.info("CDS request has %d items", n_items)
+    if n_items > _MAX_REQUEST_ITEMS:
+        raise ValueError(
+            f"The request has {n_items} items, more than the {_MAX_REQUEST_ITEMS} "
+            "allowed. Request fewer variables, days or times per call (a list of "
+            "months is already sent one month at a time)."
+        )
+    return n_items
+
+
+def _is_cached(path: Path) -> bool:
+    """
+    Check whether a previously downloaded file can be reused.
+
+    Downloads are written through `_atomic_target`, so an interrupted download
+    never leaves a truncated file at `path`. A file that does not start like a
+    netCDF or GRIB file (e.g. empty, or an error page) is removed, so that it
+    is downloaded again instead of failing later while decoding.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The path of the downloaded file.
+
+    Returns
+    -------
+    bool
+        True if the file exists and starts like a netCDF or GRIB file.
+    """
+    if not path.exists():
+        return False
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic in _MAGIC_BYTES:
+        return True
+    logger.warning("Removing invalid cached file %s", path)
+    path.unlink()
+    return False
+
+
+@contextlib.contextmanager
+def _atomic_target(path: Path) -> Iterator[Path]:
+    """
+    Provide a temporary path to write a file to, moved to `path` once complete.
+
+    The file is written next to `path` with a ".part" suffix and renamed on
+    success, so an interrupted write only ever leaves the ".part" file, which
+    is removed, and never a partial file at `path`.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The final path of the file.
+
+    Yields
+    ------
+    pathlib.Path
+        The temporary path to write to.
+    """
+    partial = path.with_suffix(path.suffix + ".part")
+    try:
+        yield partial
+        os.replace(partial, path)
+    finally:
+        partial.unlink(missing_ok=True)
+
+
+def _make_parent_directory(path: Path) -> None:
+    """
+    Create the parent directory of a path, once per process.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The path whose parent directory is created.
+    """
+    parent = path.parent
+    if parent not in _MKDIR_CACHE:
+        parent.mkdir(parents=True, exist_ok=True, mode=0o755)
+        _MKDIR_CACHE.add(parent)
+
+
+def _days_of_month(year: str, month: str) -> list:
+    """
+    List every day of a month, as zero-padded strings ('01', '02', ...).
+
+    Parameters
+    ----------
+    year : str
+        The year (e.g. '2023').
+    month : str
+        The month of the year (e.g. '02' for February).
+
+    Returns
+    -------
+    list of str
+        The days of the month.
+    """
+    _, days_in_month = calendar.monthrange(int(year), int(month))
+    return list(_ALL_DAYS[:days_in_month])
+
+
+def _retrieve_and_merge(
+    requests: List[_CdsRequest], output_path: Path, request: dict
+) -> Path:
+    """
+    Retrieve several CDS requests concurrently and merge them into one file.
+
+    Monthly files that already exist are not requested again.
+
+    Parameters
+    ----------
+    requests : list of _CdsRequest
+        The requests to retrieve.
+    output_path : pathlib.Path
+        The path of the merged file.
+    request : dict
+        The multi-month request payload, recorded next to the merged file.
+
+    Returns
+    -------
+    pathlib.Path
+        The output path of the merged data.
+    """
+    pending = [request for request in requests if not _is_cached(request.path)]
+    if pending:
+        _retrieve_all(pending)
+
+    paths = [request.path for request in requests]
+    with _atomic_target(output_path) as target:
+        if output_path.suffix == ".grib":
+            # GRIB messages are self-contained, so the files can just be concatenated
+            with open(target, "wb") as merged:
+                for path in paths:
+                    with open(path, "rb") as monthly:
+                        shutil.copyfileobj(monthly, merged)
+        else:
+            with xarray.open_mfdataset(paths, combine="by_coords") as merged:
+                merged.to_netcdf(target)
+    _write_request_sidecar(output_path, request)
+    return output_path
+
+
+def _retrieve_all(requests: List[_CdsRequest]) -> List[Path]:
+    """
+    Retrieve several CDS requests concurrently, each in its own worker thread.
+
+    Each worker waits for its result and downloads it with cdsapi, so transfers
+    overlap with the requests still queued and keep cdsapi's retries, resumed
+    downloads and client settings (timeout, SSL verification, proxies). If a
+    request fails, the requests not started yet are cancelled and the error is
+    raised straight away instead of after every other request has finished.
+
+    Parameters
+    ----------
+    requests : list of _CdsRequest
+        The requests to retrieve.
+
+    Returns
+    -------
+    list of pathlib.Path
+        The paths of the downloaded files.
+    """
+    executor = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+    try:
+        futures = [executor.submit(request.retrieve) for request in requests]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            # Raises the error of a failed request, if any
+            future.result()
+        return [future.result() for future in futures]
+    finally:
+        # Requests already running cannot be interrupted and finish in the
+        # background; their files are kept for the next call
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def get_output_path(
-    catalogue_entry, output_directory, variable, day, month, year, hour
-):
+    catalogue_entry: str,
+    output_directory: Union[str, os.PathLike],
+    variable: str,
+    day: Union[str, list, None],
+    month: Union[str, list],
+    year: str,
+    hour: Union[str, list, None],
+    request: Union[dict, None] = None,
+) -> Path:
     """
     Generate a file path for a given parameter combination.
 
-    Given the output directory, catalogue entry, variable, date, and time.
+    Given the output directory, catalogue entry, variable, date, and time. When
+    the request is given, the file name ends with a hash of it, so requests that
+    differ in any parameter (level type, product type, format, ...) never share
+    a file.
 
     Parameters
     ----------
-    output_directory : str
+    output_directory : str or os.PathLike
         The directory in which the output file will be saved.
     catalogue_entry : str
         The catalogue entry for the output file.
     variable : str
         The variable name for the output file.
-    day : str or None
+    day : str, list or None
         The day of the month for the output file (e.g. '01' for the 1st).
+        A list of days is shown by its first and last day (e.g. '01-31').
         If `None`, the day will be excluded from the file name.
-    month : str
+    month : str or list
         The month of the year for the output file (e.g. '01' for January).
+        A list of months is joined with '-'.
     year : str
         The year for the output file (e.g. '2023').
-    hour : str or None
+    hour : str, list or None
         The hour of the day for the output file (e.g. '12:00' for noon).
+        A list of hours is shown by its first and last hour (e.g. '00-23').
         If `None`, the hour will be excluded from the file name.
+    request : dict, optional
+        The full request payload sent to the CDS. Its hash is added to the file
+        name and its 'format' sets the file extension. If `None`, the file name
+        has no hash and a '.nc' extension.
 
     Returns
     -------
     output_path : pathlib.Path
         The full file path for the output file.
     """
+    if isinstance(month, list):
+        month = "-".join(month)
+    # Lists of days and hours can be long, so only their span goes in the name;
+    # the request hash below already tells apart requests with the same span
+    if isinstance(day, list):
+        day = _span(day)
+    if isinstance(hour, list):
+        hour = _span([time.split(":")[0] for time in hour])
+    elif hour:
+        hour = hour.split(":")[0]
     if day and hour:
-        date_str = "{0}{1}{2}_{3}".format(day, month, year, hour.split(":")[0])
+        date_str = "{0}{1}{2}_{3}".format(day, month, year, hour)
     elif day and not hour:
         date_str = "{0}{1}{2}".format(day, month, year)
     else:
         date_str = "{0}{1}".format(month, year)
-    output_path = (
-        f"{output_directory}/"
-        f"{catalogue_entry}/"
-        f"{variable}/"
-        f"{variable}_{date_str}.nc"
-    )
-    output_path = Path(output_path)
+    if request is None:
+        file_name = f"{variable}_{date_str}.nc"
+    else:
+        suffix = _SUFFIXES[request.get("format", "netcdf")]
+        file_name = f"{variable}_{date_str}_{_request_key(request)}{suffix}"
+    output_path = Path(output_directory) / catalogue_entry / variable / file_name
     return output_path
+
+
+def _span(values: list) -> str:
+    """Label a list of days or hours by its first and last element."""
+    return values[0] if len(values) == 1 else f"{values[0]}-{values[-1]}"
+
+
+def _request_key(request: dict) -> str:
+    """
+    Compute a stable short hash of a request payload.
+
+    Parameters
+    ----------
+    request : dict
+        The request payload sent to the CDS.
+
+    Returns
+    -------
+    str
+        A 16 character hexadecimal digest of the payload.
+    """
+    serialized = json.dumps(request, sort_keys=True).encode()
+    return hashlib.blake2b(serialized, digest_size=8).hexdigest()
+
+
+def _write_request_sidecar(path: Path, request: dict) -> None:
+    """
+    Write the request payload next to a downloaded file, for cache auditing.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The path of the downloaded file.
+    request : dict
+        The request payload sent to the CDS.
+    """
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump(request, f, indent=2, sort_keys=True)
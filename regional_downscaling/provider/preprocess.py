@@ -1,10 +1,191 @@
 import datetime
+import hashlib
+import os
+from pathlib import Path
 
+import numpy
 import pandas
 import xarray
 
+try:
+    import numba
+
+    prange = numba.prange
+except ImportError:  # numba is optional, numpy is used when it is not installed
+    numba = None
+    prange = range
+
+# Dask chunk sizes used when opening raw data, so it is loaded lazily chunk by chunk
+# instead of all at once. Dimensions missing from a dataset are ignored.
+CHUNKS = {"time": 24, "latitude": 256, "longitude": 256, "y": 256, "x": 256}
+
+# Factor, offset and resulting units to convert from each known unit
+_UNIT_CONVERTER = {
+    "Kelvin": (1, -273.15, "Celsius"),
+    "K": (1, -273.15, "Celsius"),
+    "Fahrenheit": (5 / 9, -32 * 5 / 9, "Celsius"),
+    "Celsius": (1, 0, "Celsius"),
+    "degC": (1, 0, "Celsius"),
+    "m hour**-1": (1000 * 24, 0, "mm"),
+    "mm day**-1": (1, 0, "mm"),
+    "mm": (1, 0, "mm"),
+    "m": (1000, 0, "mm"),
+    "mm s**-1": (3600 * 24, 0, "mm"),
+    "kg m**-2 day**-1": (1, 0, "mm"),
+    "kg m-2 s-1": (3600 * 24, 0, "mm"),
+    "kg m**-2": (1, 0, "mm"),
+    "kg m-2": (1, 0, "mm"),
+    "m of water equivalent": (1000, 0, "mm"),
+    "m s**-1": (1, 0, "m s-1"),
+    "m s-1": (1, 0, "m s-1"),
+    "km h**-1": (10 / 36, 0, "m s-1"),
+    "knots": (0.51, 0, "m s-1"),
+    "kts": (0.51, 0, "m s-1"),
+    "mph (nautical miles per hour)": (0.51, 0, "m s-1"),
+    "%": (1, 0, "%"),
+    "W m**-2": (1, 0, "W m-2"),
+}
+
+# Units each variable is converted to
+_VALID_UNITS = {
+    "tas": "Celsius",
+    "mx2t": "Celsius",
+    "tasmax": "Celsius",
+    "tasmin": "Celsius",
+    "hurs": "%",
+    "clt": "%",
+    "evspsbl": "kg m-2 s-1",
+    "pr": "mm",
+    "psl": "Pa",
+    "prsn": "mm",
+    "sisonc": "%",
+    "sfcwind": "m s-1",
+    "uwind": "m s**-1",
+    "vwind": "m s**-1",
+    "mrso": "kg m-2",
+    "huss": "1",
+    "sst": "Celsius",
+    "rlds": "W m-2",
+    "rsds": "W m-2",
+    "mslp": "Pa",
+    "z": "m**2 s**-2",
+}
+
+# Spatial naming conventions, checked in order: the first rule whose names are all
+# among the dataset dimensions/coordinates gives the renaming to apply
+_RENAME_RULES = [
+    (
+        {"rlon", "longitude"},
+        {"rlon": "x", "rlat": "y", "longitude": "lon", "latitude": "lat"},
+    ),
+    ({"i", "longitude"}, {"i": "x", "j": "y", "longitude": "lon", "latitude": "lat"}),
+    ({"rlon"}, {"rlon": "x", "rlat": "y"}),
+    ({"lon"}, {}),
+    ({"x"}, {"x": "lon", "y": "lat"}),
+    ({"longitude"}, {"longitude": "lon", "latitude": "lat"}),
+]
+
+# Coordinates kept by rename_and_delete_variables
+_MAIN_COORDS = frozenset(
+    {"time", "lon", "lat", "height", "x", "y", "latitude", "longitude"}
+)
+
+# Resolution the time axis is coerced to for each supported dataset frequency
+TIME_UNITS = {"D": "D", "H": "h", "MS": "D"}
+
+# Time axes already inferred in this process, since applying preprocess
+# file by file usually repeats the same axes. Holds the inferred frequency and the
+# coerced dates, keyed by a hash of the whole axis (see time_axis_key)
+_TIME_AXIS_CACHE = {}
+_TIME_AXIS_CACHE_SIZE = 256
+
+
+def open_kwargs(path) -> dict:
+    """
+    Return the xarray.open_dataset keyword arguments needed to read a download.
+
+    GRIB files are decoded with cfgrib, without writing an index file next to
+    the data.
+
+    Parameters
+    ----------
+    path (str or os.PathLike): path of the downloaded file
+
+    Returns
+    -------
+    kwargs (dict): keyword arguments for xarray.open_dataset or
+        xarray.open_mfdataset
+    """
+    if Path(path).suffix == ".grib":
+        return {"engine": "cfgrib", "backend_kwargs": {"indexpath": ""}}
+    return {}
 
-def preprocess(ds: xarray.Dataset, project: str, variable: str, variable_map: dict):
+
+def open_for_preprocess(paths, chunks: dict = None, **kwargs) -> xarray.Dataset:
+    """
+    Open downloaded data lazily, ready to be preprocessed.
+
+    The files are opened with dask, so `preprocess` builds a graph and nothing is
+    read until the result is written or computed, which keeps memory bounded for
+    files larger than RAM.
+
+    Parameters
+    ----------
+    paths (str, os.PathLike or list): file or files to open
+    chunks (dict): dask chunk sizes, dimensions missing from the data are ignored.
+        Defaults to CHUNKS
+    kwargs: extra keyword arguments for xarray.open_mfdataset, e.g. the engine
+
+    Returns
+    -------
+    ds (xarray.Dataset): dask-backed dataset
+    """
+    if chunks is None:
+        chunks = CHUNKS
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    return xarray.open_mfdataset(
+        paths,
+        chunks=chunks,
+        combine="by_coords",
+        parallel=True,
+        **{**open_kwargs(paths[0]), **kwargs},
+    )
+
+
+def preprocess(
+    ds: xarray.Dataset,
+    project: str,
+    variable: str,
+    variable_map: dict,
+    chunks: dict = None,
+):
+    """
+    Harmonise a raw dataset: coordinate names, variables, longitudes and units.
+
+    All the steps are lazy, so a dask-backed dataset (e.g. opened with
+    `chunks=CHUNKS`) stays dask-backed and is only computed when written or when
+    the caller calls `.compute()`. Large inputs should be opened with
+    `open_for_preprocess`; an in-memory dataset can instead be chunked here
+    through `chunks`.
+
+    Parameters
+    ----------
+    ds (xarray.Dataset): data stored by dimensions
+    project (str): project of the process e.g ERA5, CERRA...
+    variable (str): name of the variable to keep
+    variable_map (dict): dictionary for mapping the variables of the different
+        datasets
+    chunks (dict): dask chunk sizes to apply before preprocessing, dimensions
+        missing from the dataset are ignored. Defaults to keeping the chunking of
+        `ds`
+
+    Returns
+    -------
+    ds (xarray.Dataset): preprocessed dataset
+    """
+    if chunks is not None:
+        ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
     ds = fix_spatial_coord_names(ds)
     # ds = fix_non_standard_calendar(ds)
     ds = rename_and_delete_variables(ds, variable, variable_map)
@@ -41,9 +222,9 @@ def fix_non_standard_calendar(dataset: xarray.Dataset) -> xarray.Dataset:
         real_time = pandas.date_range(
             start=coerced[0].replace(day=1), end=coerced[-1], freq=dataset_frequency
         )
-    # Removing 29 (no leap years) and 30 feb
-    dataset = dataset.where(~dataset.time.isnull(), drop=True)
-    # Filling missing dates (31 of every month)
+    # Removing 29 (no leap years) and 30 feb, which only needs the time index, and
+    # filling missing dates (31 of every month)
+    dataset = dataset.isel(time=~coerced.isna())
     dataset = dataset.reindex({"time": real_time}, method="ffill")
     return dataset
 
@@ -65,24 +246,72 @@ def infer_dataset_frequency(dataset):
     coerced (pandas.Datetime): dates stored in pandas object
     """
     try:
+        key = time_axis_key(dataset.time.values)
+        if key in _TIME_AXIS_CACHE:
+            # Move the axis to the end, so the least recently used is evicted first
+            _TIME_AXIS_CACHE[key] = _TIME_AXIS_CACHE.pop(key)
+            return _TIME_AXIS_CACHE[key]
         dataset_frequency = xarray.infer_freq(dataset.time)
-        if dataset_frequency == "D":
-            string_dates = [str(d)[:10] for d in dataset.time.values]
-        elif dataset_frequency == "H":
-            string_dates = [str(d) for d in dataset.time.values]
-        elif dataset_frequency == "MS":
-            string_dates = [str(d)[:10] for d in dataset.time.values]
-        elif dataset_frequency is None or dataset_frequency == "30D":
-            string_dates = [str(d)[:10] for d in dataset.time.values]
+        if dataset_frequency is None or dataset_frequency == "30D":
             dataset_frequency = "MS"
-        else:
+        if dataset_frequency not in TIME_UNITS:
             raise NotImplementedError
-        coerced = pandas.to_datetime(string_dates, errors="coerce")
+        coerced = coerce_times(dataset.time.values, TIME_UNITS[dataset_frequency])
+        if len(_TIME_AXIS_CACHE) >= _TIME_AXIS_CACHE_SIZE:
+            _TIME_AXIS_CACHE.pop(next(iter(_TIME_AXIS_CACHE)))
+        _TIME_AXIS_CACHE[key] = dataset_frequency, coerced
         return dataset_frequency, coerced
     except Exception as ex:
         raise Exception(ex)
 
 
+def time_axis_key(times: numpy.ndarray) -> tuple:
+    """
+    Identify a time axis by its dtype, calendar and a hash of all its dates.
+
+    Hashing the raw dates is several times cheaper than inferring the frequency,
+    and unlike the first/last dates and length it also tells irregular axes apart.
+
+    Parameters
+    ----------
+    times (numpy.ndarray): numpy.datetime64 or cftime dates
+
+    Returns
+    -------
+    key (tuple): hashable key of the time axis
+    """
+    if numpy.issubdtype(times.dtype, numpy.datetime64):
+        data = numpy.ascontiguousarray(times).view("i8")
+    else:
+        # cftime dates: hash their text, which includes the microseconds
+        data = times.astype("U26")
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    return times.dtype.str, getattr(times.flat[0], "calendar", None), digest
+
+
+def coerce_times(times: numpy.ndarray, unit: str) -> pandas.DatetimeIndex:
+    """
+    Coerce dates of any calendar to standard calendar dates.
+
+    Parameters
+    ----------
+    times (numpy.ndarray): numpy.datetime64 or cftime dates
+    unit (str): resolution of the coerced dates, "D" (daily) or "h" (hourly)
+
+    Returns
+    -------
+    coerced (pandas.DatetimeIndex): coerced dates, NaT for those missing from the
+        standard calendar (e.g. 30 February)
+    """
+    if numpy.issubdtype(times.dtype, numpy.datetime64):
+        times = times.astype(f"datetime64[{unit}]")
+    else:
+        # cftime dates: format them as text so that dates missing from the
+        # standard calendar are coerced to NaT
+        times = times.astype("U19" if unit == "h" else "U10")
+    return pandas.to_datetime(times, errors="coerce")
+
+
 def fix_spatial_coord_names(dataset: xarray.Dataset) -> xarray.Dataset:
     """
     Fix the coordinates names for spatial coordinates (x, y, lon, lat, ...).
@@ -97,29 +326,11 @@ def fix_spatial_coord_names(dataset: xarray.Dataset) -> xarray.Dataset:
     -------
      dataset (xarray.Dataset): data with the remaining coordinates "lon" and "lat"
     """
-    if ("rlon" in dataset.dims or "rlon" in dataset.coords) and (
-        "longitude" in dataset.dims or "longitude" in dataset.coords
-    ):
-        return dataset.rename(
-            {"rlon": "x", "rlat": "y", "longitude": "lon", "latitude": "lat"}
-        )
-    elif ("i" in dataset.dims or "i" in dataset.coords) and (
-        "longitude" in dataset.dims or "longitude" in dataset.coords
-    ):
-        return dataset.rename(
-            {"i": "x", "j": "y", "longitude": "lon", "latitude": "lat"}
-        )
-    elif "rlon" in dataset.dims or "rlon" in dataset.coords:
-        return dataset.rename({"rlon": "x", "rlat": "y"})
-
-    elif "lon" in dataset.dims or "lon" in dataset.coords:
-        return dataset
-    elif "x" in dataset.dims or "y" in dataset.coords:
-        return dataset.rename({"x": "lon", "y": "lat"})
-    elif "longitude" in dataset.dims or "longitude" in dataset.coords:
-        return dataset.rename({"longitude": "lon", "latitude": "lat"})
-    else:
-        raise NotImplementedError
+    names = set(dataset.dims) | set(dataset.coords)
+    for required, mapping in _RENAME_RULES:
+        if required <= names:
+            return dataset.rename(mapping) if mapping else dataset
+    raise NotImplementedError
 
 
 def fix_360_longitudes(
@@ -142,10 +353,24 @@ def fix_360_longitudes(
     """
     lonname = lonname if "CERRA" not in project else "longitude"
     lon = dataset[lonname]
-    if lon.max().values > 180 and lon.min().values >= 0:
-        dataset[lonname] = dataset[lonname].where(lon <= 180, other=lon - 360)
-    if "CERRA" not in project and len(dataset.lat.shape) != 2:
-        dataset = dataset.reindex(**{lonname: sorted(dataset[lonname])})
+    # Longitudes are small, so reduce them in memory rather than through dask
+    lon_vals = lon.values
+    # NaN longitudes (e.g. outside the domain) are ignored, as xarray's max/min do
+    if numpy.nanmax(lon_vals) > 180 and numpy.nanmin(lon_vals) >= 0:
+        lon_vals = _shift_longitudes(lon_vals)
+        dataset = dataset.assign_coords({lonname: lon.copy(data=lon_vals)})
+    if (
+        "CERRA" not in project
+        and len(dataset.lat.shape) != 2
+        and not numpy.all(numpy.diff(lon_vals) >= 0)
+    ):
+        # Shifting a sorted 0-360 axis leaves two sorted runs, so rotating it to
+        # start at its minimum sorts it in linear time. Other axes are sorted
+        start = int(numpy.argmin(lon_vals))
+        order = numpy.r_[start : lon_vals.size, 0:start]
+        if not numpy.all(numpy.diff(lon_vals[order]) >= 0):
+            order = numpy.argsort(lon_vals, kind="stable")
+        dataset = dataset.isel({lonname: order})
     return dataset
 
 
@@ -175,13 +400,11 @@ def rename_and_delete_variables(
     ds = ds.rename_vars({var_name: variable})
     # adding height coordinate
     ds = ds.assign_coords({"height": 2.0})
-    # avoiding useless variables
+    # avoiding useless variables and dimensions
     ds = ds[[variable]]
-    # delete useless dimensions
-    main_coords = ["time", "lon", "lat", "height", "x", "y", "latitude", "longitude"]
-    if sorted(list(ds.coords)) != sorted(main_coords):
-        dim_to_remove = [dim for dim in list(ds.coords) if dim not in main_coords]
-        ds = ds.drop_vars(dim_to_remove)
+    extra_coords = set(ds.coords) - _MAIN_COORDS
+    if extra_coords:
+        ds = ds.drop_vars(extra_coords)
     if "time" not in list(ds.dims):
         ds = ds.expand_dims("time")
     return ds
@@ -202,62 +425,89 @@ def convert_units(ds: xarray.Dataset) -> xarray.Dataset:
     -------
     ds (xarray.Dataset): data with the new units
     """
-
-    UNIT_CONVERTER = {
-        "Kelvin": (1, -273.15, "Celsius"),
-        "K": (1, -273.15, "Celsius"),
-        "Fahrenheit": (5 / 9, -32 * 5 / 9, "Celsius"),
-        "Celsius": (1, 0, "Celsius"),
-        "degC": (1, 0, "Celsius"),
-        "m hour**-1": (1000 * 24, 0, "mm"),
-        "mm day**-1": (1, 0, "mm"),
-        "mm": (1, 0, "mm"),
-        "m": (1000, 0, "mm"),
-        "mm s**-1": (3600 * 24, 0, "mm"),
-        "kg m**-2 day**-1": (1, 0, "mm"),
-        "kg m-2 s-1": (3600 * 24, 0, "mm"),
-        "kg m**-2": (1, 0, "mm"),
-        "kg m-2": (1, 0, "mm"),
-        "m of water equivalent": (1000, 0, "mm"),
-        "m s**-1": (1, 0, "m s-1"),
-        "m s-1": (1, 0, "m s-1"),
-        "km h**-1": (10 / 36, 0, "m s-1"),
-        "knots": (0.51, 0, "m s-1"),
-        "kts": (0.51, 0, "m s-1"),
-        "mph (nautical miles per hour)": (0.51, 0, "m s-1"),
-        "%": (1, 0, "%"),
-        "W m**-2": (1, 0, "W m-2"),
-    }
-
-    VALID_UNITS = {
-        "tas": "Celsius",
-        "mx2t": "Celsius",
-        "tasmax": "Celsius",
-        "tasmin": "Celsius",
-        "hurs": "%",
-        "clt": "%",
-        "evspsbl": "kg m-2 s-1",
-        "pr": "mm",
-        "psl": "Pa",
-        "prsn": "mm",
-        "sisonc": "%",
-        "sfcwind": "m s-1",
-        "uwind": "m s**-1",
-        "vwind": "m s**-1",
-        "mrso": "kg m-2",
-        "huss": "1",
-        "sst": "Celsius",
-        "rlds": "W m-2",
-        "rsds": "W m-2",
-        "mslp": "Pa",
-        "z": "m**2 s**-2",
-    }
-
-    for ds_var in list(ds.data_vars):
-        if ds[ds_var].attrs["units"] == VALID_UNITS[ds_var]:
+    new_vars = {}
+    for ds_var, data in ds.data_vars.items():
+        units = data.attrs["units"]
+        if units == _VALID_UNITS[ds_var]:
             continue
+        scale, offset, new_units = _UNIT_CONVERTER[units]
+        if scale == 1 and offset == 0:
+            # Same quantity under another name: relabel without touching the data
+            new_vars[ds_var] = data.assign_attrs(units=new_units)
         else:
-            conversion = UNIT_CONVERTER[ds[ds_var].attrs["units"]]
-            ds[ds_var] = ds[ds_var] * conversion[0] + conversion[1]
-            ds[ds_var].attrs["units"] = conversion[2]
+            # One fused elementwise step per chunk instead of a multiply and an add
+            new_vars[ds_var] = xarray.apply_ufunc(
+                _apply_affine,
+                data,
+                kwargs={"scale": scale, "offset": offset},
+                dask="allowed",
+                keep_attrs=True,
+            ).assign_attrs(units=new_units)
+    # Replace all the converted variables at once
+    if new_vars:
+        ds = ds.assign(new_vars)
     return ds
+
+
+def _apply_affine(values, scale, offset):
+    """
+    Apply _affine to a numpy or dask array.
+
+    Dask arrays get a single map_blocks layer, which dask="parallelized" would
+    wrap in two more (apply_gufunc output and transpose). numba is only used on
+    in-memory data, dask already runs chunks in parallel.
+    """
+    if isinstance(values, numpy.ndarray):
+        return (_affine if numba is None else _affine_numba)(values, scale, offset)
+    dtype = numpy.result_type(values.dtype, scale, offset)
+    return values.map_blocks(_affine, scale, offset, dtype=dtype)
+
+
+def _affine(values, scale, offset):
+    """Compute values * scale + offset, skipping the no-op operation."""
+    if scale != 1:
+        values = values * scale
+    if offset != 0:
+        values = values + offset
+    return values
+
+
+def _shift_longitudes(lon_vals):
+    """Return a copy of lon_vals with the longitudes over 180 moved by -360."""
+    if numba is None:
+        return numpy.subtract(lon_vals, 360, out=lon_vals.copy(), where=lon_vals > 180)
+    lon_vals = numpy.ascontiguousarray(lon_vals)
+    shifted = numpy.empty_like(lon_vals)
+    _shift_longitudes_kernel(lon_vals.ravel(), shifted.ravel())
+    return shifted
+
+
+def _affine_numba(values, scale, offset):
+    """Compute values * scale + offset in a single parallel pass with numba."""
+    values = numpy.ascontiguousarray(values)
+    result = numpy.empty(
+        values.shape, dtype=numpy.result_type(values.dtype, scale, offset)
+    )
+    cast = result.dtype.type
+    _affine_kernel(values.ravel(), cast(scale), cast(offset), result.ravel())
+    return result
+
+
+def _affine_kernel(values, scale, offset, result):
+    """Write values * scale + offset to result, for 1D arrays."""
+    for i in prange(values.size):
+        result[i] = values[i] * scale + offset
+
+
+def _shift_longitudes_kernel(lon_vals, shifted):
+    """Write lon_vals to shifted, moving the longitudes over 180 by -360."""
+    for i in prange(lon_vals.size):
+        shifted[i] = lon_vals[i] - 360 if lon_vals[i] > 180 else lon_vals[i]
+
+
+# The kernels are plain Python loops, compiled in parallel when numba is installed
+if numba is not None:
+    _affine_kernel = numba.njit(parallel=True, cache=True)(_affine_kernel)
+    _shift_longitudes_kernel = numba.njit(parallel=True, cache=True)(
+        _shift_longitudes_kernel
+    )
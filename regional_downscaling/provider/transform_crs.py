@@ -1,6 +1,26 @@
+import hashlib
+import os
+
+import numpy as np
 import pyproj
 import xarray as xr
-import xesmf as xe
+
+# Regridders already built in this process, keyed by source grid, target grid
+# and method, since computing the weights is much slower than applying them
+_REGRIDDER_CACHE = {}
+
+# Methods whose weights depend on the cell bounds as well as the cell centres
+CONSERVATIVE_METHODS = ("conservative", "conservative_normed")
+
+# Number of grid points reprojected per call to PROJ, small enough for the points
+# being transformed to stay in cache on large grids
+TRANSFORM_TILE_SIZE = 1 << 20
+
+# Names the grid coordinates are looked up by, in order, as xesmf does
+_GRID_COORD_NAMES = {
+    "lon": ("lon", "longitude"),
+    "lat": ("lat", "latitude"),
+}
 
 
 def reproject_dataset(ds, input_crs, output_crs, output_file):
@@ -19,21 +39,17 @@ def reproject_dataset(ds, input_crs, output_crs, output_file):
         The output file path to save the reprojected dataset to.
     """
 
-    # Define the projection objects for the input and output CRS
-    in_proj = pyproj.Proj(input_crs)
-    out_proj = pyproj.Proj(output_crs)
+    # Build the transformation pipeline once, for the whole coordinate grid
+    transformer = pyproj.Transformer.from_crs(input_crs, output_crs, always_xy=True)
 
-    # Reproject the input data to the output CRS
-    lon, lat = pyproj.transform(
-        in_proj, out_proj, ds.longitude.values, ds.latitude.values
-    )
-    data, _, _ = pyproj.transform(
-        in_proj, out_proj, ds.values, lon, lat, always_xy=True
-    )
+    # Reproject the grid coordinates to the output CRS
+    lon, lat = transform_in_tiles(transformer, ds.longitude.values, ds.latitude.values)
 
-    # Create a new xarray Dataset with the reprojected data
+    # Reprojecting moves the grid points, not the values on them, so the data is
+    # carried over unchanged (use interpolate_dataset to regrid the values)
     ds_reprojected = xr.Dataset(
-        {"data": (["lat", "lon"], data)}, coords={"lat": lat[:, 0], "lon": lon[0, :]}
+        {name: (["lat", "lon"], da.values) for name, da in ds.data_vars.items()},
+        coords={"lat": lat[:, 0], "lon": lon[0, :]},
     )
 
     # Set the coordinate reference system for the new Dataset
@@ -43,10 +59,42 @@ def reproject_dataset(ds, input_crs, output_crs, output_file):
     ds_reprojected.to_netcdf(output_file)
 
 
-def interpolate_dataset(ds, grid, method, output_file):
+def transform_in_tiles(transformer, x, y, tile_size=TRANSFORM_TILE_SIZE):
+    """
+    Transform coordinates with a pyproj Transformer, a tile of points at a time.
+
+    Parameters
+    ----------
+    transformer : pyproj.Transformer
+        The transformation to apply.
+    x, y : numpy.ndarray
+        The input coordinates, of the same shape.
+    tile_size : int
+        The number of points transformed per call.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The transformed coordinates, with the same shape as the input ones.
+    """
+    x_flat, y_flat = np.ravel(x), np.ravel(y)
+    out_x, out_y = np.empty_like(x_flat, dtype=float), np.empty_like(
+        y_flat, dtype=float
+    )
+    for start in range(0, x_flat.size, tile_size):
+        tile = slice(start, start + tile_size)
+        out_x[tile], out_y[tile] = transformer.transform(x_flat[tile], y_flat[tile])
+    return out_x.reshape(np.shape(x)), out_y.reshape(np.shape(y))
+
+
+def interpolate_dataset(ds, grid, method, output_file, weights_directory="/tmp"):
     """
     Interpolate an xarray Dataset to a new grid using xesmf.
 
+    Regridding weights are cached per source grid, target grid and method, in
+    memory and as netCDF files in `weights_directory`, so they are only computed
+    once for a given pair of grids.
+
     Parameters
     ----------
     ds : xarray.Dataset
@@ -58,13 +106,108 @@ def interpolate_dataset(ds, grid, method, output_file):
         'nearest_d2s', 'patch', and 'regrid_doc'.
     output_file : str
         The output file path to save the interpolated dataset to.
+    weights_directory : str
+        The directory where the regridding weights are stored.
     """
 
-    # Create the xesmf regridder object
-    regridder = xe.Regridder(ds, grid, method)
+    # Get the xesmf regridder object, computing its weights only if needed
+    regridder = get_regridder(ds, grid, method, weights_directory)
 
     # Interpolate the input data to the target grid
     ds_interpolated = regridder(ds)
 
     # Write the interpolated data to a netCDF file
     ds_interpolated.to_netcdf(output_file)
+
+
+def get_regridder(ds, grid, method, weights_directory):
+    """
+    Get an xesmf regridder, reusing weights computed before for the same grids.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The input dataset to interpolate.
+    grid : xarray.Dataset or dict
+        The target grid to interpolate to.
+    method : str
+        The interpolation method to use.
+    weights_directory : str
+        The directory where the regridding weights are stored.
+
+    Returns
+    -------
+    xesmf.Regridder
+        The regridder from the grid of `ds` to `grid`.
+    """
+    import xesmf as xe
+
+    bounds = method in CONSERVATIVE_METHODS
+    key = f"{grid_hash(ds, bounds)}_{grid_hash(grid, bounds)}_{method}"
+    if key not in _REGRIDDER_CACHE:
+        # xesmf writes the weights to the file, or reads them back if it exists
+        weights_file = os.path.join(weights_directory, f"weights_{key}.nc")
+        _REGRIDDER_CACHE[key] = xe.Regridder(
+            ds,
+            grid,
+            method,
+            filename=weights_file,
+            reuse_weights=os.path.exists(weights_file),
+        )
+    return _REGRIDDER_CACHE[key]
+
+
+def grid_hash(grid, bounds=False):
+    """
+    Hash the fields of a grid that xesmf computes the regridding weights from.
+
+    The coordinates are looked up as 'lon'/'lat' or 'longitude'/'latitude', and
+    their cell bounds as 'lon_b'/'lat_b' or through the CF 'bounds' attribute.
+    The cell bounds and the 'mask' are hashed too when xesmf uses them, so grids
+    that only differ in those do not share weights.
+
+    Parameters
+    ----------
+    grid : xarray.Dataset or dict
+        The grid.
+    bounds : bool
+        Whether to hash the cell bounds, used by the conservative methods.
+
+    Returns
+    -------
+    str
+        The md5 hex digest of the grid fields.
+    """
+    fields = {}
+    for axis, names in _GRID_COORD_NAMES.items():
+        name = _find_grid_coord(grid, names)
+        fields[axis] = grid[name]
+        if bounds:
+            fields[f"{axis}_b"] = grid[_find_grid_bounds(grid, axis, name)]
+    if "mask" in grid:
+        fields["mask"] = grid["mask"]
+    md5 = hashlib.md5()
+    for name, field in fields.items():
+        values = np.ascontiguousarray(field, dtype="float64")
+        md5.update(name.encode())
+        md5.update(str(values.shape).encode())
+        md5.update(values.tobytes())
+    return md5.hexdigest()
+
+
+def _find_grid_coord(grid, names):
+    """Return the first of names that is a variable of grid."""
+    for name in names:
+        if name in grid:
+            return name
+    raise KeyError(f"The grid has none of the coordinates {names}")
+
+
+def _find_grid_bounds(grid, axis, name):
+    """Return the name of the cell bounds of the grid coordinate name."""
+    if f"{axis}_b" in grid:
+        return f"{axis}_b"
+    bounds = getattr(grid[name], "attrs", {}).get("bounds")
+    if bounds is not None and bounds in grid:
+        return bounds
+    raise KeyError(f"The grid has no cell bounds for the coordinate {name!r}")
@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import dask.array
+import numpy
+import pandas
+import xarray
+from pytest_mock import MockerFixture
+
+from regional_downscaling.analysis.analysis import main
+from regional_downscaling.provider import download
+
+
+def test_main_returns_lazy_datasets(mocker: MockerFixture, tmp_path: Path):
+    time = pandas.date_range("2021-01-01", periods=2, freq="H")
+    era5_path, cerra_path = tmp_path / "era5.nc", tmp_path / "cerra.nc"
+    xarray.Dataset(
+        {
+            "t2m": (
+                ("time", "latitude", "longitude"),
+                numpy.full((2, 2, 3), 273.15),
+                {"units": "K"},
+            )
+        },
+        coords={
+            "time": time,
+            "latitude": [50.0, 40.0],
+            "longitude": [0.0, 90.0, 270.0],
+        },
+    ).to_netcdf(era5_path)
+    xarray.Dataset(
+        {"t2m": (("time", "y", "x"), numpy.full((2, 2, 3), 273.15), {"units": "K"})},
+        coords={
+            "time": time,
+            "latitude": (("y", "x"), numpy.full((2, 3), 45.0)),
+            "longitude": (("y", "x"), [[340.0, 350.0, 0.0], [345.0, 355.0, 5.0]]),
+        },
+    ).to_netcdf(cerra_path)
+    mocker.patch.object(download, "download_era5_data", return_value=era5_path)
+    mocker.patch.object(download, "download_cerra_data", return_value=cerra_path)
+
+    era5, cerra = main()
+
+    assert isinstance(era5.tas.data, dask.array.Array)
+    assert isinstance(cerra.tas.data, dask.array.Array)
+    numpy.testing.assert_allclose(era5.tas, 0.0)
+    numpy.testing.assert_allclose(cerra.tas, 0.0)
+    numpy.testing.assert_array_equal(era5.lon, [-90.0, 0.0, 90.0])
@@ -1,13 +1,36 @@
+import json
+import threading
 from pathlib import Path
 
+import numpy
+import pandas
+import pytest
+import xarray
 from pytest_mock import MockerFixture
 
-from regional_downscaling.provider.download import download_cerra_data
+from regional_downscaling.provider import download
+from regional_downscaling.provider.download import (
+    download_cerra_data,
+    download_era5_data,
+    get_output_path,
+)
+from regional_downscaling.provider.preprocess import open_kwargs
+
+
+@pytest.fixture(autouse=True)
+def reset_clients(mocker: MockerFixture):
+    # Drop the per-thread CDS clients so every test sees its own mock
+    mocker.patch.object(download, "_local", threading.local())
+
+
+def write_result(name: str, payload: dict, target: Path):
+    # cdsapi writes the result to the target it is given
+    Path(target).write_bytes(b"GRIB" + bytes(100))
 
 
 def test_download_cerra_data(mocker: MockerFixture, tmp_path: Path):
     # Set up mock CDSAPI client and retrieve method
-    mock_retrieve = mocker.patch("cdsapi.Client.retrieve")
+    mock_retrieve = mocker.patch("cdsapi.Client.retrieve", side_effect=write_result)
     mock_cdsapi = mocker.patch(
         "cdsapi.Client", return_value=mocker.Mock(retrieve=mock_retrieve)
     )
@@ -38,27 +61,212 @@ def test_download_cerra_data(mocker: MockerFixture, tmp_path: Path):
         output_directory=output_directory,
     )
 
+    expected_request = {
+        "variable": variable,
+        "level_type": level_type,
+        "data_type": data_type,
+        "product_type": product_type,
+        "year": year,
+        "month": month,
+        "day": day,
+        "time": time,
+        "format": fmt,
+    }
+
     # Assert that the output path is correct
     expected_output_path = (
         tmp_path / f"reanalysis-cerra-single-levels/{variable}/"
-        f"{variable}_{day}{month}{year}_{time.split(':')[0]}.nc"
+        f"{variable}_{day}{month}{year}_{time.split(':')[0]}_"
+        f"{download._request_key(expected_request)}.nc"
     )
     assert output_path == expected_output_path
 
     # Assert that the CDSAPI client was called with the correct arguments
     mock_cdsapi.assert_called_once()
+    # The result is written next to the output path and moved there once complete
     mock_retrieve.assert_called_once_with(
         "reanalysis-cerra-single-levels",
-        {
-            "variable": variable,
-            "level_type": level_type,
-            "data_type": data_type,
-            "product_type": product_type,
-            "year": year,
-            "month": month,
-            "day": day,
-            "time": time,
-            "format": fmt,
-        },
-        output_path,
+        expected_request,
+        output_path.with_suffix(".nc.part"),
+    )
+    assert output_path.exists()
+
+    # Assert that the request was recorded next to the data
+    with open(output_path.with_suffix(".json")) as f:
+        assert json.load(f) == expected_request
+
+
+def test_get_output_path_depends_on_request():
+    kwargs = dict(
+        catalogue_entry="reanalysis-era5-single-levels",
+        output_directory="/tmp",
+        variable="2m_temperature",
+        day="01",
+        month="01",
+        year="2021",
+        hour="00:00",
     )
+    netcdf_path = get_output_path(**kwargs, request={"format": "netcdf"})
+    grib_path = get_output_path(**kwargs, request={"format": "grib"})
+    assert netcdf_path != grib_path
+    assert netcdf_path == get_output_path(**kwargs, request={"format": "netcdf"})
+
+    # Without a request, the name has no hash
+    assert get_output_path(**kwargs).name == "2m_temperature_01012021_00.nc"
+
+    # The output directory may be given as a path object too
+    kwargs["output_directory"] = Path("/tmp")
+    assert netcdf_path == get_output_path(**kwargs, request={"format": "netcdf"})
+
+
+def test_download_era5_data_per_month(mocker: MockerFixture, tmp_path: Path):
+    # HDF5 is not thread-safe, so the fake downloads write one at a time
+    lock = threading.Lock()
+
+    def fake_retrieve(name, payload, target):
+        time = pandas.date_range(f"2021-{payload['month']}-01", periods=1)
+        ds = xarray.Dataset({"t2m": ("time", [280.0])}, coords={"time": time})
+        with lock:
+            ds.to_netcdf(target)
+
+    mock_retrieve = mocker.patch("cdsapi.Client").return_value.retrieve
+    mock_retrieve.side_effect = fake_retrieve
+
+    output_path = download_era5_data(
+        month=["01", "02"],
+        day="01",
+        time="00:00",
+        fmt="netcdf",
+        output_directory=str(tmp_path),
+    )
+
+    # One request per month, merged into a single file
+    assert mock_retrieve.call_count == 2
+    assert sorted(call.args[1]["month"] for call in mock_retrieve.call_args_list) == [
+        "01",
+        "02",
+    ]
+    with xarray.open_dataset(output_path) as merged:
+        assert merged.time.size == 2
+
+
+def test_download_era5_data_per_month_grib(mocker: MockerFixture, tmp_path: Path):
+    def fake_retrieve(name, payload, target):
+        Path(target).write_bytes(f"GRIB{payload['month']}7777".encode())
+
+    mocker.patch("cdsapi.Client").return_value.retrieve.side_effect = fake_retrieve
+
+    output_path = download_era5_data(
+        month=["01", "02"], day="01", time="00:00", output_directory=str(tmp_path)
+    )
+
+    # GRIB months are merged by concatenating the files in month order
+    assert output_path.suffix == ".grib"
+    assert output_path.read_bytes() == b"GRIB017777GRIB027777"
+    assert open_kwargs(output_path)["engine"] == "cfgrib"
+
+
+def test_download_era5_data_per_month_time_list(mocker: MockerFixture, tmp_path: Path):
+    mock_retrieve = mocker.patch("cdsapi.Client").return_value.retrieve
+    mock_retrieve.side_effect = write_result
+
+    output_path = download_era5_data(
+        month=["01", "02"],
+        day=["01", "02"],
+        time=["00:00", "06:00"],
+        output_directory=str(tmp_path),
+    )
+
+    assert mock_retrieve.call_count == 2
+    assert output_path.name.startswith("2m_temperature_01-0201-022021_00-06_")
+    assert output_path.exists()
+
+
+def test_failed_month_cancels_pending_requests(mocker: MockerFixture, tmp_path: Path):
+    mocker.patch.object(download, "_MAX_WORKERS", 1)
+    release = threading.Event()
+    requested = []
+
+    def fake_retrieve(name, payload, target):
+        requested.append(payload["month"])
+        if payload["month"] == "01":
+            raise RuntimeError("request failed")
+        release.wait()
+
+    mocker.patch("cdsapi.Client").return_value.retrieve.side_effect = fake_retrieve
+
+    # The error is raised while February is still running, and March is dropped
+    with pytest.raises(RuntimeError, match="request failed"):
+        download_era5_data(
+            month=["01", "02", "03"], day="01", output_directory=str(tmp_path)
+        )
+    release.set()
+    assert "03" not in requested
+
+
+def test_client_is_reused(mocker: MockerFixture, tmp_path: Path):
+    mock_cdsapi = mocker.patch("cdsapi.Client")
+    mock_cdsapi.return_value.retrieve.side_effect = write_result
+
+    download_era5_data(day="01", output_directory=str(tmp_path))
+    download_era5_data(day="02", output_directory=str(tmp_path))
+
+    mock_cdsapi.assert_called_once()
+    assert mock_cdsapi.return_value.retrieve.call_count == 2
+
+
+def test_oversized_request_is_rejected(mocker: MockerFixture, tmp_path: Path):
+    mock_cdsapi = mocker.patch("cdsapi.Client")
+
+    with pytest.raises(ValueError, match="items"):
+        download_era5_data(
+            variable=[f"variable_{i}" for i in range(200)],
+            day=None,
+            time=None,
+            output_directory=str(tmp_path),
+        )
+
+    mock_cdsapi.assert_not_called()
+
+
+def test_invalid_cached_file_is_downloaded_again(mocker: MockerFixture, tmp_path: Path):
+    mock_cdsapi = mocker.patch("cdsapi.Client")
+    mock_cdsapi.return_value.retrieve.side_effect = write_result
+    output_path = download_era5_data(output_directory=str(tmp_path))
+
+    # A download killed before writing anything leaves an empty file behind
+    output_path.write_bytes(b"")
+    assert download_era5_data(output_directory=str(tmp_path)) == output_path
+    assert mock_cdsapi.return_value.retrieve.call_count == 2
+
+    # A complete file is reused
+    output_path.write_bytes(b"GRIB" + bytes(100))
+    download_era5_data(output_directory=str(tmp_path))
+    assert mock_cdsapi.return_value.retrieve.call_count == 2
+
+
+def test_interrupted_download_is_not_cached(mocker: MockerFixture, tmp_path: Path):
+    source = tmp_path / "source.nc"
+    xarray.Dataset({"t2m": ("time", numpy.arange(1000.0))}).to_netcdf(source)
+    complete = source.read_bytes()
+    output_directory = tmp_path / "downloads"
+
+    def interrupted_retrieve(name, payload, target):
+        # The connection drops halfway through the file
+        Path(target).write_bytes(complete[: len(complete) // 2])
+        raise ConnectionError("connection reset")
+
+    mock_cdsapi = mocker.patch("cdsapi.Client")
+    mock_cdsapi.return_value.retrieve.side_effect = interrupted_retrieve
+    with pytest.raises(ConnectionError):
+        download_era5_data(fmt="netcdf", output_directory=output_directory)
+    assert list(output_directory.rglob("*.nc*")) == []
+
+    # The next call downloads the file again instead of reusing half of it
+    def complete_retrieve(name, payload, target):
+        Path(target).write_bytes(complete)
+
+    mock_cdsapi.return_value.retrieve.side_effect = complete_retrieve
+    output_path = download_era5_data(fmt="netcdf", output_directory=output_directory)
+    with xarray.open_dataset(output_path) as downloaded:
+        assert downloaded.t2m.size == 1000
@@ -0,0 +1,264 @@
+import types
+
+import dask.array
+import numpy
+import pandas
+import pytest
+import xarray
+
+from regional_downscaling.provider import preprocess as preprocess_module
+from regional_downscaling.provider.preprocess import (
+    CHUNKS,
+    convert_units,
+    fix_360_longitudes,
+    fix_non_standard_calendar,
+    fix_spatial_coord_names,
+    infer_dataset_frequency,
+    open_for_preprocess,
+    preprocess,
+)
+
+
+def era5_dataset() -> xarray.Dataset:
+    return xarray.Dataset(
+        {
+            "t2m": (
+                ("time", "latitude", "longitude"),
+                numpy.full((4, 3, 4), 273.15),
+                {"units": "K"},
+            )
+        },
+        coords={
+            "time": pandas.date_range("2021-01-01", periods=4, freq="H"),
+            "latitude": [60.0, 50.0, 40.0],
+            "longitude": [0.0, 90.0, 180.0, 270.0],
+        },
+    )
+
+
+def test_preprocess_era5():
+    ds = era5_dataset().assign_coords(number=0, step=("time", numpy.zeros(4)))
+    ds["sp"] = ds.t2m.assign_attrs(units="Pa")
+
+    ds = preprocess(ds, "ERA5", "tas", {"tas": "t2m"})
+
+    assert list(ds.data_vars) == ["tas"]
+    assert set(ds.coords) == {"time", "lat", "lon", "height"}
+    assert ds.tas.attrs["units"] == "Celsius"
+    numpy.testing.assert_allclose(ds.tas, 0.0)
+    numpy.testing.assert_array_equal(ds.lon, [-90.0, 0.0, 90.0, 180.0])
+
+
+def test_preprocess_is_lazy():
+    ds = era5_dataset().chunk({"time": 2})
+
+    ds = preprocess(ds, "ERA5", "tas", {"tas": "t2m"})
+
+    assert isinstance(ds.tas.data, dask.array.Array)
+    assert ds.tas.dtype == numpy.float64
+    numpy.testing.assert_allclose(ds.tas, 0.0)
+
+
+def test_open_for_preprocess(tmp_path):
+    path = tmp_path / "era5.nc"
+    era5_dataset().to_netcdf(path)
+
+    ds = preprocess(open_for_preprocess(path), "ERA5", "tas", {"tas": "t2m"})
+
+    assert isinstance(ds.tas.data, dask.array.Array)
+    numpy.testing.assert_allclose(ds.tas, 0.0)
+
+
+def test_preprocess_chunks():
+    ds = preprocess(era5_dataset(), "ERA5", "tas", {"tas": "t2m"}, chunks=CHUNKS)
+
+    assert isinstance(ds.tas.data, dask.array.Array)
+    assert ds.tas.chunks == ((4,), (3,), (4,))
+    assert list(ds.lon.values) == [-90.0, 0.0, 90.0, 180.0]
+
+
+def test_infer_dataset_frequency_non_standard_calendar():
+    time = xarray.cftime_range("2000-02-28", periods=4, freq="D", calendar="360_day")
+    ds = xarray.Dataset(coords={"time": time})
+
+    frequency, coerced = infer_dataset_frequency(ds)
+
+    assert frequency == "D"
+    assert coerced[2] is pandas.NaT  # 30 February
+    assert coerced[3] == pandas.Timestamp("2000-03-01")
+
+
+def test_fix_non_standard_calendar():
+    time = xarray.cftime_range("2001-01-29", periods=33, freq="D", calendar="360_day")
+    ds = xarray.Dataset({"tas": ("time", numpy.arange(33.0))}, coords={"time": time})
+
+    ds = fix_non_standard_calendar(ds)
+
+    assert ds.time.size == 60  # 1 January to 1 March
+    selected = ds.tas.sel(time=["2001-01-30", "2001-01-31", "2001-02-28", "2001-03-01"])
+    assert list(selected.values) == [1.0, 1.0, 29.0, 32.0]
+
+
+def test_infer_dataset_frequency_is_cached():
+    time = xarray.cftime_range("2000-02-28", periods=4, freq="D", calendar="360_day")
+    noleap = xarray.cftime_range("2000-02-28", periods=4, freq="D", calendar="noleap")
+
+    _, coerced = infer_dataset_frequency(xarray.Dataset(coords={"time": time}))
+    _, cached = infer_dataset_frequency(xarray.Dataset(coords={"time": time}))
+    _, other = infer_dataset_frequency(xarray.Dataset(coords={"time": noleap}))
+
+    assert cached is coerced
+    assert not other.isna().any()
+
+    # Same first/last dates and length, but not daily
+    daily = pandas.date_range("2000-01-01", periods=4, freq="D")
+    irregular = daily.insert(1, pandas.Timestamp("2000-01-01 12:00")).delete(2)
+    assert infer_dataset_frequency(xarray.Dataset(coords={"time": daily}))[0] == "D"
+    frequency, _ = infer_dataset_frequency(xarray.Dataset(coords={"time": irregular}))
+    assert frequency == "MS"
+
+
+def test_infer_dataset_frequency_hourly():
+    time = pandas.date_range("2000-01-01", periods=3, freq="H")
+    ds = xarray.Dataset(coords={"time": time})
+
+    frequency, coerced = infer_dataset_frequency(ds)
+
+    assert frequency == "H"
+    assert (coerced == time).all()
+
+
+def test_convert_units():
+    ds = xarray.Dataset(
+        {
+            "tas": ("time", [32.0, 212.0], {"units": "Fahrenheit"}),
+            "sst": ("time", [1.5, 2.5], {"units": "degC"}),
+            "pr": ("time", [1.0, 2.0], {"units": "mm"}),
+        }
+    )
+
+    converted = convert_units(ds)
+
+    numpy.testing.assert_allclose(converted.tas, [0.0, 100.0])
+    numpy.testing.assert_array_equal(converted.sst, [1.5, 2.5])
+    assert converted.tas.attrs["units"] == "Celsius"
+    assert converted.sst.attrs["units"] == "Celsius"
+    assert converted.pr.attrs["units"] == "mm"
+
+
+def test_fix_spatial_coord_names():
+    rotated = xarray.Dataset(
+        coords={
+            "rlat": [0.0, 1.0],
+            "rlon": [0.0, 1.0],
+            "latitude": (("rlat", "rlon"), numpy.zeros((2, 2))),
+            "longitude": (("rlat", "rlon"), numpy.zeros((2, 2))),
+        }
+    )
+    assert set(fix_spatial_coord_names(rotated).coords) == {"x", "y", "lat", "lon"}
+
+    regular = era5_dataset()
+    assert set(fix_spatial_coord_names(regular).dims) == {"time", "lat", "lon"}
+
+    renamed = fix_spatial_coord_names(regular.rename(latitude="lat", longitude="lon"))
+    assert set(renamed.dims) == {"time", "lat", "lon"}
+
+    with pytest.raises(NotImplementedError):
+        fix_spatial_coord_names(xarray.Dataset(coords={"time": [0]}))
+
+
+def test_fix_360_longitudes():
+    ds = xarray.Dataset(
+        {"tas": (("lat", "lon"), dask.array.from_array([[0.0, 1.0, 2.0, 3.0]]))},
+        coords={"lat": [0.0], "lon": [90.0, 270.0, 0.0, 180.0]},
+    )
+
+    ds = fix_360_longitudes(ds, project="ERA5")
+
+    assert isinstance(ds.tas.data, dask.array.Array)
+    numpy.testing.assert_array_equal(ds.lon, [-90.0, 0.0, 90.0, 180.0])
+    numpy.testing.assert_array_equal(ds.tas, [[1.0, 2.0, 0.0, 3.0]])
+
+
+def test_fix_360_longitudes_with_nan():
+    lon = numpy.array([[0.0, 90.0, 180.0], [190.0, 270.0, numpy.nan]])
+    cerra = xarray.Dataset(
+        coords={
+            "longitude": (("y", "x"), lon),
+            "latitude": (("y", "x"), numpy.zeros((2, 3))),
+        }
+    )
+
+    cerra = fix_360_longitudes(cerra, project="CERRA")
+
+    expected = [[0.0, 90.0, 180.0], [-170.0, -90.0, numpy.nan]]
+    numpy.testing.assert_array_equal(cerra.longitude, expected)
+
+    era5 = xarray.Dataset(coords={"lat": [0.0], "lon": [0.0, 190.0, numpy.nan]})
+    era5 = fix_360_longitudes(era5, project="ERA5")
+    numpy.testing.assert_array_equal(era5.lon, [-170.0, 0.0, numpy.nan])
+
+
+def test_fix_360_longitudes_sorted_axis():
+    lon = numpy.arange(0.0, 360.0, 45.0)
+    ds = xarray.Dataset(
+        {"tas": (("lat", "lon"), dask.array.from_array([lon], chunks=3))},
+        coords={"lat": [0.0], "lon": lon},
+    )
+
+    ds = fix_360_longitudes(ds, project="ERA5")
+
+    expected = [-135.0, -90.0, -45.0, 0.0, 45.0, 90.0, 135.0, 180.0]
+    numpy.testing.assert_array_equal(ds.lon, expected)
+    numpy.testing.assert_array_equal(ds.tas, [numpy.mod(expected, 360)])
+
+
+@pytest.fixture(params=["python", "numba"])
+def numba_kernels(request, monkeypatch):
+    if request.param == "numba":
+        pytest.importorskip("numba")
+    else:
+        # Take the numba code path, with the kernels running as plain Python
+        monkeypatch.setattr(preprocess_module, "numba", types.SimpleNamespace())
+    return monkeypatch
+
+
+def test_convert_units_numba(numba_kernels):
+    values = numpy.random.default_rng(0).uniform(-40, 110, (5, 3)).astype("float32")
+    # Transposed, so the data is not C-contiguous
+    ds = xarray.Dataset({"tas": (("x", "y"), values.T, {"units": "Fahrenheit"})})
+    with numba_kernels.context() as m:
+        m.setattr(preprocess_module, "numba", None)
+        expected = convert_units(ds.copy())
+
+    converted = convert_units(ds.copy())
+
+    assert converted.tas.dtype == numpy.float32
+    numpy.testing.assert_array_equal(converted.tas, expected.tas)
+    assert converted.tas.attrs["units"] == "Celsius"
+
+
+def test_fix_360_longitudes_numba(numba_kernels):
+    lon = numpy.array([[0.0, 90.0, 180.0], [190.0, 270.0, numpy.nan]]).T
+    ds = xarray.Dataset(
+        {"tas": (("x", "y"), numpy.zeros((3, 2)))},
+        coords={
+            "longitude": (("x", "y"), lon),
+            "latitude": (("x", "y"), numpy.zeros((3, 2))),
+        },
+    )
+    kernel = preprocess_module._shift_longitudes_kernel
+    calls = []
+
+    def counted_kernel(*args):
+        calls.append(args)
+        return kernel(*args)
+
+    numba_kernels.setattr(preprocess_module, "_shift_longitudes_kernel", counted_kernel)
+
+    fixed = fix_360_longitudes(ds, project="CERRA")
+
+    assert len(calls) == 1
+    expected = numpy.array([[0.0, 90.0, 180.0], [-170.0, -90.0, numpy.nan]]).T
+    numpy.testing.assert_array_equal(fixed.longitude, expected)
+    numpy.testing.assert_array_equal(ds.longitude, lon)
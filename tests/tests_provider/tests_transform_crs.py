@@ -0,0 +1,63 @@
+import numpy
+import pyproj
+import pytest
+import xarray
+
+from regional_downscaling.provider import transform_crs
+from regional_downscaling.provider.transform_crs import grid_hash, transform_in_tiles
+
+
+def regular_grid(lon_name="lon", lat_name="lat") -> xarray.Dataset:
+    lon = numpy.arange(-10.0, 10.0, 2.0)
+    lat = numpy.arange(30.0, 50.0, 4.0)
+    return xarray.Dataset(
+        {
+            lon_name: ((lon_name,), lon),
+            lat_name: ((lat_name,), lat),
+            "lon_b": (("lon_b",), numpy.append(lon - 1, lon[-1] + 1)),
+            "lat_b": (("lat_b",), numpy.append(lat - 2, lat[-1] + 2)),
+        }
+    )
+
+
+def test_transform_in_tiles():
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:3035", always_xy=True)
+    lon, lat = numpy.meshgrid(numpy.linspace(-10, 30, 7), numpy.linspace(35, 70, 5))
+    expected = transformer.transform(lon, lat)
+    result = transform_in_tiles(transformer, lon, lat, tile_size=4)
+    for result_coord, expected_coord in zip(result, expected):
+        assert result_coord.shape == lon.shape
+        numpy.testing.assert_allclose(result_coord, expected_coord)
+
+
+def test_grid_hash():
+    grid = regular_grid()
+    assert grid_hash(grid) == grid_hash(regular_grid())
+    # CF names are hashed like the short ones
+    cf_grid = regular_grid("longitude", "latitude")
+    assert grid_hash(cf_grid) == grid_hash(grid)
+    # Bounds only count for the conservative methods
+    shifted_bounds = grid.assign(lon_b=grid["lon_b"] + 0.5)
+    assert grid_hash(shifted_bounds) == grid_hash(grid)
+    assert grid_hash(shifted_bounds, bounds=True) != grid_hash(grid, bounds=True)
+    # CF bounds are found through the 'bounds' attribute
+    cf_bounds = grid.rename(lon_b="lon_bnds")
+    cf_bounds["lon"].attrs["bounds"] = "lon_bnds"
+    assert grid_hash(cf_bounds, bounds=True) == grid_hash(grid, bounds=True)
+    # A mask changes the weights
+    masked = grid.assign(mask=(("lat", "lon"), numpy.ones((5, 10))))
+    assert grid_hash(masked) != grid_hash(grid)
+    with pytest.raises(KeyError):
+        grid_hash(xarray.Dataset({"x": (("x",), [0.0, 1.0])}))
+
+
+def test_get_regridder_is_cached(tmp_path, monkeypatch):
+    pytest.importorskip("xesmf")
+    monkeypatch.setattr(transform_crs, "_REGRIDDER_CACHE", {})
+    source = regular_grid("longitude", "latitude")
+    target = regular_grid().isel(lon=slice(1, -1))
+    regridder = transform_crs.get_regridder(source, target, "bilinear", tmp_path)
+    assert len(list(tmp_path.glob("weights_*.nc"))) == 1
+    assert transform_crs.get_regridder(source, target, "bilinear", tmp_path) is (
+        regridder
+    )